@@ -3,18 +3,22 @@ Module with cosmological and dynamical timescale calculations.
 
 """
 
+import os
+
 import numpy as np
-from scipy.integrate import quad
-from scipy.interpolate import interp1d
+from scipy.integrate import cumulative_trapezoid
+from scipy.interpolate import interp1d, PchipInterpolator
 from astropy.cosmology import FlatLambdaCDM
 
 # Constants for unit conversion
 const1 = 0.102271217  # 100km/s/Mpc = const1 Gyr^-1, H0 = h * const1 Gyr^-1
 const2 = 3.2407793E-18  # 100km/s/Mpc = const2 s^-1, H0 = h * const2 s^-1
 G = 4.5170908E-48  # grav. constant in s^-2/(Msun/Mpc^3)
+_PI2 = np.pi * np.pi
 
-# Snapshot scale factors in TNG
-a_list = np.load('a_list.npy')
+# Snapshot scale factors in TNG, stored next to this module
+a_list = np.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'a_list.npy'), mmap_mode='r')
 
 
 class LCDMCosmology:
@@ -53,23 +57,40 @@ class LCDMCosmology:
         self.a_list = a_list
         self.z_list = 1 / a_list - 1
 
+        # Constant prefactors of rho_c and t_dyn
+        self._rho_c_prefac = (3 * h * h * const2 * const2
+                              / (8 * np.pi * G))
+        self._t_dyn_prefac = np.pi / h / const1
+
+        # Cosmic age is tabulated once, astropy integrates on every call
+        a_grid = np.geomspace(1e-3, 1, 4096)
+        self._age_interp = interp1d(
+            a_grid, self.cosmo.age(1 / a_grid - 1).to_value('Gyr'),
+            kind='cubic', assume_sorted=True)
+
+        # Dynamical times since the first snapshot, used by n_dyn
+        self._a_interp = np.geomspace(1e-3, 1, 100000)
+        self._n_interp = self.n_dyn_grid(self._a_interp)
+        self.n_list = self.n_dyn(self.a_list)
+
     def e2(self, a):
         """ Calculates the E^2 function for the specified LambdaCDM
         cosmology at scale factor a, where E(a) = H(a) / H0.
 
         Parameters
         ----------
-        a : float
-          Scale factor.
+        a : float or array_like
+          Scale factor(s).
 
         Returns
         -------
-        E2 : float
-          The E^2 function at epoch a.
+        E2 : float or array_like
+          The E^2 function at epoch a. Has same shape as the input a.
 
         """
 
-        return self.omega_m / (a ** 3) + self.omega_l
+        a = np.asarray(a)
+        return self.omega_m / (a * a * a) + self.omega_l
 
     def delta_c(self, a):
         """ Calculates the virial overdensity with respect to the
@@ -78,19 +99,22 @@ class LCDMCosmology:
 
         Parameters
         ----------
-        a : float
-          Scale factor.
+        a : float or array_like
+          Scale factor(s).
 
         Returns
         -------
-        Delta_c : float
+        Delta_c : float or array_like
           The virial overdensity with respect to the critical density
-          of the universe at scale factor a.
+          of the universe at scale factor a. Has same shape as the input a.
 
         """
 
-        x = - self.omega_l / self.e2(a)
-        return 18 * np.pi * np.pi + 82 * x - 39 * x * x
+        return self._delta_c_e2(self.e2(a))
+
+    def _delta_c_e2(self, e2):
+        x = - self.omega_l / e2
+        return 18 * _PI2 + x * (82 - 39 * x)
 
     def rho_c(self, a):
         """ Calculates the critical density of the universe, for the
@@ -99,55 +123,190 @@ class LCDMCosmology:
 
         Parameters
         ----------
-        a : float
-          Scale factor.
+        a : float or array_like
+          Scale factor(s).
 
         Returns
         -------
-        rho_c : float
+        rho_c : float or array_like
           The critical density of the universe at scale factor a. In
-          physical units of Msun / Mpc^3.
+          physical units of Msun / Mpc^3. Has same shape as the input a.
+
+        """
+
+        return self._rho_c_prefac * self.e2(a)
+
+    def cosmo_age(self, a):
+        """ Calculates the age of the universe at scale factor a, in Gyr,
+        interpolated from a table computed at initialization.
+
+        Parameters
+        ----------
+        a : float or array_like
+          Scale factor(s), between 0.001 and 1.
+
+        Returns
+        -------
+        age : float or array_like
+          The age of the universe at scale factor a, in Gyr. Has same
+          shape as the input a.
+
+        """
+
+        return self._age_interp(a)
+
+    def t_dyn(self, a):
+        """ Calculates the dynamical time of virialized halos at scale
+        factor a, in Gyr.
+
+        Parameters
+        ----------
+        a : float or array_like
+          Scale factor(s).
+
+        Returns
+        -------
+        t_dyn : float or array_like
+          The dynamical time at scale factor a, in Gyr. Has same shape as
+          the input a.
+
+        """
+
+        e2 = self.e2(a)
+        return self._t_dyn_prefac / np.sqrt(e2 * 2 * self._delta_c_e2(e2))
+
+    def n_dyn(self, a, aref=None):
+        """ Calculates the number of dynamical times elapsed between aref
+        and a, interpolated from a table computed at initialization.
+
+        Parameters
+        ----------
+        a : float or array_like
+          Scale factor(s), between 0.001 and 1.
+
+        aref : float, optional
+          Reference scale factor from which the dynamical times are
+          counted, default is the first snapshot.
+
+        Returns
+        -------
+        n_dyn : float or array_like
+          The number of dynamical times at scale factor a since aref,
+          negative if a is before aref. Has same shape as the input a.
 
         """
 
-        return (3 * self.h * self.h * const2 * const2
-                * self.e2(a) / 8 / np.pi / G)
+        n = np.interp(a, self._a_interp, self._n_interp)
+        if aref is None:
+            return n
+        return n - np.interp(aref, self._a_interp, self._n_interp)
+
+    def n_dyn_grid(self, a_grid, aref=None):
+        """ Calculates the number of dynamical times since aref on a grid
+        of scale factors, with a single cumulative trapezoidal integration
+        instead of one quadrature per grid point.
+
+        Parameters
+        ----------
+        a_grid : array_like
+          Monotonically increasing scale factors. Should be dense enough
+          for the trapezoidal rule to converge.
 
-    def cosmo_age(self, a):  # in Gyr
-        z = 1 / a - 1
-        return self.cosmo.age(z)
+        aref : float, optional
+          Reference scale factor from which the dynamical times are
+          counted, default is the first snapshot.
 
-    def t_dyn(self, a): # in Gyr
-        return np.pi / self.h / const1 / np.sqrt(self.e2(a) * 2 * self.delta_c(a))
+        Returns
+        -------
+        n_dyn : array_like
+          The number of dynamical times at each scale factor in a_grid,
+          negative before aref.
 
+        """
 
-# change to take a instead of z as input
-    def n_dyn(self, a, aref=None): # number of tdyn's at a since ai
         if aref is None:
             aref = self.a_list[0]
-        z = 1 / a - 1
-        zref = 1 / aref - 1
-        return quad(lambda x: 1 / (1 + x) / self.t_dyn(1 / (1 + x)) / np.sqrt(self.e2(x)),
-                    z, zref)[0] / self.h / const1
+        a_grid = np.asarray(a_grid)
+        # dt = da / (a H(a)), counted in units of t_dyn(a)
+        integrand = 1 / (a_grid * self.t_dyn(a_grid)
+                         * np.sqrt(self.e2(a_grid))) / self.h / const1
+        n_cum = cumulative_trapezoid(integrand, a_grid, initial=0)
+        return n_cum - np.interp(aref, a_grid, n_cum)
 
-a_interp = np.linspace(0.02, 1, 1000)
-n_interp = np.array([n_dyn(a) for a in a_interp])
-ntau_a = interp1d(a_interp, n_interp)
-a_ntau = interp1d(n_interp, a_interp)
 
-z_list = 1 / a_list - 1
-n_list = ntau_a(a_list)
+tng = LCDMCosmology()
+
+# Monotone splines through the same table, so a_ntau inverts ntau_a
+ntau_a = PchipInterpolator(tng._a_interp, tng._n_interp, extrapolate=False)
+a_ntau = PchipInterpolator(tng._n_interp, tng._a_interp, extrapolate=False)
+
+# Per-snapshot lookups, indexed by snapshot number
+z_list = tng.z_list
+n_list = tng.n_list
 
 # Major mergers
 
-def a_before_mm(a_mm, n_back = 1):
+# Dynamical times between the first snapshot and a = 1
+_N_MAX = float(ntau_a(1.0))
+
+
+def _ntau_mm(a_mm):
+    # ntau_a does not extrapolate and gives nan outside its table, which
+    # would slip through the range checks of the callers
     n_mm = ntau_a(a_mm)
-    n_before = n_mm - 1
-    assert n_before >= 0
+    if np.isnan(n_mm):
+        raise ValueError('a = {} is outside the tabulated range [{}, {}]'
+                         .format(a_mm, tng._a_interp[0], tng._a_interp[-1]))
+    return n_mm
+
+
+def a_before_mm(a_mm, n_back=1):
+    """ Finds the scale factor n_back dynamical times before a major
+    merger.
+
+    Parameters
+    ----------
+    a_mm : float
+      Scale factor of the major merger.
+
+    n_back : float, optional
+      Number of dynamical times to go back, default is 1.
+
+    Returns
+    -------
+    a_before : float
+      The scale factor n_back dynamical times before a_mm.
+
+    """
+
+    n_before = _ntau_mm(a_mm) - n_back
+    if n_before < 0:
+        raise ValueError('{} dynamical times before a = {} is earlier '
+                         'than the first snapshot'.format(n_back, a_mm))
     return a_ntau(n_before)
 
-def a_after_mm(a_mm, n_forth = 1):
-    n_mm = ntau_a(a_mm)
-    n_after = n_mm + 1
-    assert n_after <= ntau_a(1)
+
+def a_after_mm(a_mm, n_forth=1):
+    """ Finds the scale factor n_forth dynamical times after a major
+    merger.
+
+    Parameters
+    ----------
+    a_mm : float
+      Scale factor of the major merger.
+
+    n_forth : float, optional
+      Number of dynamical times to go forward, default is 1.
+
+    Returns
+    -------
+    a_after : float
+      The scale factor n_forth dynamical times after a_mm.
+
+    """
+
+    n_after = _ntau_mm(a_mm) + n_forth
+    if n_after > _N_MAX:
+        raise ValueError('{} dynamical times after a = {} is later '
+                         'than a = 1'.format(n_forth, a_mm))
     return a_ntau(n_after)
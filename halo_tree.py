@@ -3,37 +3,111 @@ Module that constructs halo-based merger trees from the subhalo-based trees.
 
 """
 
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import locate_object
 import load_sublink
 
-_grsn_combo_const = 1000000000000
+# Group number and snapshot number are combined into one int64 key, with
+# the snapshot number in the bits above _grsn_shift
+_grsn_shift = 40
+_grsn_mask = (1 << _grsn_shift) - 1
 
 
-def _groupnum_sn_1to2(groupsnapnum):
-    return [groupsnapnum % _grsn_combo_const,
-            groupsnapnum // _grsn_combo_const]
+# Functions decorated with _memoize, whose caches clear_cache empties
+_memoized = []
 
 
-def _groupnum_sn_2to1(groupnum, snapnum):
-    return snapnum * _grsn_combo_const + groupnum
+def _memoize(func):
+    # Caches the halo lookups along tree walks, with one LRU cache per sim.
+    # The caches are held by weak reference to their sim, and only hold a
+    # weak reference to it themselves, so a sim that is no longer used is
+    # freed with its cache and its loaded catalogs. Returned arrays are
+    # shared between calls, so they are made read-only. See clear_cache.
+    caches = weakref.WeakKeyDictionary()
 
+    @functools.wraps(func)
+    def cached(subhaloid, sim, *args, **kwargs):
+        cache = caches.get(sim)
+        if cache is None:
+            sim_ref = weakref.ref(sim)
 
-def all_immediate_progenitor_halos(groupnum, snapnum, sim,
-                                   subhalo_numlimit=20,
-                                   previous_snapshot_only=False):
-    """ Finds the immediate progenitor halos of the given halo, defined as
-    all the halos in the previous snapshot that host progenitors of subhalos
-    in the given halo, sorted by virial mass.
+            @functools.lru_cache(maxsize=4096)
+            def cache(subhaloid, *args, **kwargs):
+                result = func(subhaloid, sim_ref(), *args, **kwargs)
+                for arr in result:
+                    arr.flags.writeable = False
+                return result
+            caches[sim] = cache
+        return cache(subhaloid, *args, **kwargs)
+
+    cached.caches = caches
+    _memoized.append(cached)
+    return cached
+
+
+def clear_cache(sim=None):
+    """ Empties the caches of halo lookups that the merger tree functions
+    keep for each simulation box. The caches are freed together with their
+    simulation box, so this is only needed to release memory while the
+    box is still in use, or after its catalogs have been reloaded with
+    different data.
 
     Parameters
     ----------
-    groupnum : int
-      The
+    sim : class obj, optional
+      Instance of the simulation_box.SimulationBox class whose caches to
+      empty. Default is None, in which case the caches of all simulation
+      boxes are emptied.
+
+    Returns
+    -------
+    None :
+      Empties the caches.
 
     """
 
+    for cached in _memoized:
+        if sim is None:
+            cached.caches.clear()
+        else:
+            cached.caches.pop(sim, None)
+    return
+
+
+def _groupnum_sn_2to1(groupnum, snapnum):
+    groupsnapnum = np.left_shift(snapnum, _grsn_shift, dtype=np.int64)
+    return np.bitwise_or(groupsnapnum, groupnum, out=groupsnapnum)
+
+
+def _unique_grnr_snap(groupnum, snapnum, masses, numkeep=0):
+    # Indices of the first subhalo of each distinct (group, snapshot) halo,
+    # ordered by descending mass, from one stable sort of the packed keys.
+    # The keys are never unpacked, callers gather the columns by index.
+    # With numkeep, only the numkeep most massive are selected and sorted.
+    keys = _groupnum_sn_2to1(groupnum, snapnum)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    keep = np.empty(len(keys), dtype=bool)
+    keep[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=keep[1:])
+    idx = order[keep]
+    neg_masses = -masses[idx]
+    if numkeep and numkeep < len(idx):
+        top = np.argpartition(neg_masses, numkeep - 1)[:numkeep]
+        return idx[top[np.argsort(neg_masses[top])]]
+    return idx[np.argsort(neg_masses)]
+
+
+def _all_immediate_halos(groupnum, snapnum, sim, subhalo_numlimit,
+                         load_immediate_batch, adjacent_snapnum=None):
+    # Shared by all_immediate_progenitor_halos and
+    # all_immediate_descendant_halos, which only differ in the batch
+    # loader and in which adjacent snapshot they can be restricted to
     central_sfid = locate_object.subfind_central(groupnum, snapnum, sim)
     central_shid = locate_object.sublink_id(central_sfid, snapnum, sim)
     fields = ['SubhaloID', 'Group_M_TopHat200', 'GroupMass',
@@ -44,34 +118,45 @@ def all_immediate_progenitor_halos(groupnum, snapnum, sim,
                                                  numlimit=subhalo_numlimit)
                 ['SubhaloID'])
 
-    immediate_progenitor_subhalos = load_sublink.merge_tree_dicts(
-        [load_sublink.load_immediate_progenitors(
-            subhalo, fields, sim)
-            for subhalo in subhalos],
-        fields=fields)
-    if immediate_progenitor_subhalos['Number'] == 0:
+    immediate_subhalos = load_immediate_batch(subhalos, fields, sim)
+    if immediate_subhalos['Number'] == 0:
         return np.array([], dtype='int64'), np.array([], dtype='int64'), \
                np.array([], dtype='<f4')
 
-    immediate_progenitors = _groupnum_sn_2to1(
-        immediate_progenitor_subhalos['SubhaloGrNr'],
-        immediate_progenitor_subhalos['SnapNum'])
-    immediate_progenitors, idx = np.unique(immediate_progenitors,
-                                           return_index=True)
-    progenitor_masses = immediate_progenitor_subhalos['Group_M_TopHat200'][idx]
-    order = np.argsort(-progenitor_masses)
+    groupnums = immediate_subhalos['SubhaloGrNr']
+    snapnums = immediate_subhalos['SnapNum']
+    masses = immediate_subhalos['Group_M_TopHat200']
+    if adjacent_snapnum is not None:
+        mask = snapnums == adjacent_snapnum
+        groupnums = groupnums[mask]
+        snapnums = snapnums[mask]
+        masses = masses[mask]
+    idx = _unique_grnr_snap(groupnums, snapnums, masses)
 
-    immediate_progenitors = _groupnum_sn_1to2(immediate_progenitors[order])
-    progenitor_masses = progenitor_masses[order]
+    # Group and snapshot numbers are returned as int64, as for empty results,
+    # and not in the narrower types they are stored in
+    return (groupnums[idx].astype(np.int64), snapnums[idx].astype(np.int64),
+            masses[idx])
 
-    if previous_snapshot_only:
-        mask = immediate_progenitors[1] == snapnum - 1
-        immediate_progenitors[0] = immediate_progenitors[0][mask]
-        immediate_progenitors[1] = immediate_progenitors[1][mask]
-        progenitor_masses = progenitor_masses[mask]
 
-    return (immediate_progenitors[0], immediate_progenitors[1],
-            progenitor_masses)
+def all_immediate_progenitor_halos(groupnum, snapnum, sim,
+                                   subhalo_numlimit=20,
+                                   previous_snapshot_only=False):
+    """ Finds the immediate progenitor halos of the given halo, defined as
+    all the halos in the previous snapshot that host progenitors of subhalos
+    in the given halo, sorted by virial mass.
+
+    Parameters
+    ----------
+    groupnum : int
+      The
+
+    """
+
+    return _all_immediate_halos(
+        groupnum, snapnum, sim, subhalo_numlimit,
+        load_sublink.load_immediate_progenitors_batch,
+        adjacent_snapnum=snapnum - 1 if previous_snapshot_only else None)
 
 
 def all_immediate_descendant_halos(groupnum, snapnum, sim,
@@ -83,43 +168,13 @@ def all_immediate_descendant_halos(groupnum, snapnum, sim,
 
     """
 
-    central_sfid = locate_object.subfind_central(groupnum, snapnum, sim)
-    central_shid = locate_object.sublink_id(central_sfid, snapnum, sim)
-    fields = ['SubhaloID', 'Group_M_TopHat200', 'GroupMass',
-              'SubhaloGrNr', 'SnapNum']
-    subhalos = load_sublink.load_group_subhalos(central_shid,
-                                                fields, sim, numlimit=subhalo_numlimit)['SubhaloID']
-
-    immediate_descendant_subhalos = load_sublink.merge_tree_dicts(
-        [load_sublink.load_immediate_descendant(
-            subhalo, fields, sim)
-            for subhalo in subhalos],
-        fields=fields)
-    if immediate_descendant_subhalos['Number'] == 0:
-        return np.array([], dtype='int64'), np.array([], dtype='int64'), \
-               np.array([], dtype='<f4')
-
-    immediate_descendants = _groupnum_sn_2to1(
-        immediate_descendant_subhalos['SubhaloGrNr'],
-        immediate_descendant_subhalos['SnapNum'])
-    immediate_descendants, idx = np.unique(immediate_descendants,
-                                           return_index=True)
-    descendant_masses = immediate_descendant_subhalos['Group_M_TopHat200'][idx]
-    order = np.argsort(-descendant_masses)
-
-    immediate_descendants = _groupnum_sn_1to2(immediate_descendants[order])
-    descendant_masses = descendant_masses[order]
-
-    if next_snapshot_only:
-        mask = immediate_descendants[1] == snapnum + 1
-        immediate_descendants[0] = immediate_descendants[0][mask]
-        immediate_descendants[1] = immediate_descendants[1][mask]
-        descendant_masses = descendant_masses[mask]
-
-    return (immediate_descendants[0], immediate_descendants[1],
-            descendant_masses)
+    return _all_immediate_halos(
+        groupnum, snapnum, sim, subhalo_numlimit,
+        load_sublink.load_immediate_descendants_batch,
+        adjacent_snapnum=snapnum + 1 if next_snapshot_only else None)
 
 
+@_memoize
 def _immediate_progenitor_halos(subhaloid, sim,
                                 subhalo_numlimit=20,
                                 previous_snapshot_only=False,
@@ -136,49 +191,35 @@ def _immediate_progenitor_halos(subhaloid, sim,
     subhalos = group_subhalos['SubhaloID']
     snapnum = group_subhalos['SnapNum'][0]
 
-    immediate_progenitor_subhalos = load_sublink.merge_tree_dicts(
-        [load_sublink.load_immediate_progenitors(
-            subhalo, fields, sim)
-            for subhalo in subhalos],
-        fields=fields)
+    immediate_progenitor_subhalos = (
+        load_sublink.load_immediate_progenitors_batch(subhalos, fields, sim))
     if immediate_progenitor_subhalos['Number'] == 0:
         return np.array([], dtype='int64'), np.array([], dtype='int64'), \
                np.array([], dtype='<f4')
 
     mask = (immediate_progenitor_subhalos['SubhaloID'] ==
             immediate_progenitor_subhalos['FirstSubhaloInFOFGroupID'])
-    immediate_progenitors = _groupnum_sn_2to1(
-        immediate_progenitor_subhalos['SubhaloGrNr'][mask],
-        immediate_progenitor_subhalos['SnapNum'][mask])
-    immediate_progenitors, idx = np.unique(immediate_progenitors,
-                                           return_index=True)
-    progenitor_subs = immediate_progenitor_subhalos['SubhaloID'][mask][idx]
-    progenitor_masses = (immediate_progenitor_subhalos['Group_M_TopHat200']
-                         [mask][idx])
-    order = np.argsort(-progenitor_masses)
-
-    immediate_progenitors = _groupnum_sn_1to2(immediate_progenitors[order])
-    progenitor_subs = progenitor_subs[order]
-    progenitor_masses = progenitor_masses[order]
-
+    # Snapshot cut goes before the ranking, so that numkeep selects among
+    # the remaining halos only
     if previous_snapshot_only:
-        mask = immediate_progenitors[1] == snapnum - 1
-        immediate_progenitors[0] = immediate_progenitors[0][mask]
-        immediate_progenitors[1] = immediate_progenitors[1][mask]
-        progenitor_subs = progenitor_subs[mask]
-        progenitor_masses = progenitor_masses[mask]
-
-    if numkeep:
-        numkeep = np.min([numkeep, len(progenitor_masses)])
-        return (immediate_progenitors[0][:numkeep],
-                immediate_progenitors[1][:numkeep],
-                progenitor_masses[:numkeep],
-                progenitor_subs[:numkeep])
+        mask &= immediate_progenitor_subhalos['SnapNum'] == snapnum - 1
+    idx = np.flatnonzero(mask)
+    progenitor_groupnums = immediate_progenitor_subhalos['SubhaloGrNr'][idx]
+    progenitor_snapnums = immediate_progenitor_subhalos['SnapNum'][idx]
+    progenitor_masses = (immediate_progenitor_subhalos['Group_M_TopHat200']
+                         [idx])
+    idx = idx[_unique_grnr_snap(progenitor_groupnums, progenitor_snapnums,
+                                progenitor_masses, numkeep)]
 
-    return (immediate_progenitors[0], immediate_progenitors[1],
-            progenitor_masses, progenitor_subs)
+    # Group and snapshot numbers are returned as int64, as for empty results
+    return (immediate_progenitor_subhalos['SubhaloGrNr'][idx]
+            .astype(np.int64),
+            immediate_progenitor_subhalos['SnapNum'][idx].astype(np.int64),
+            immediate_progenitor_subhalos['Group_M_TopHat200'][idx],
+            immediate_progenitor_subhalos['SubhaloID'][idx])
 
 
+@_memoize
 def _immediate_descendant_halo(subhaloid, sim,
                                next_snapshot_only=False):
     """ Finds the immediate descendant halo of the given halo.
@@ -206,6 +247,7 @@ def _immediate_descendant_halo(subhaloid, sim,
             descendant_mass, descendant_sub['SubhaloID'])
 
 
+@_memoize
 def _self_halo(subhaloid, sim):
     """ Finds the immediate progenitor halos of the given halo,
     sorted by virial mass.
@@ -228,42 +270,123 @@ def main_merger_tree(subhaloid, sim,
 
     """
 
-    main_halos = {'GrNr': [], 'SnapNum': [], 'Group_M_TopHat200': []}
-    incoming_halos = {'GrNr': [], 'SnapNum': [], 'Group_M_TopHat200': []}
+    keys = ('GrNr', 'SnapNum', 'Group_M_TopHat200')
+    dtypes = ('i8', 'i2', 'f4')
+
     head = subhaloid
     result = _self_halo(head, sim)
     headgroup = result[0][0]
+
+    # Snapshot numbers strictly decrease along the main branch, so there
+    # are at most snapnum + 1 main and incoming halos, filled backwards to
+    # end up ordered from early to late. The descendants follow the
+    # DescendantID chain of the subhalo and are filled forwards after
+    # them, at most up to the snapshot of its root descendant.
+    size = int(result[1][0]) + 1
+    main_size = size
+    if track_descendants:
+        # RootDescendantID is a single hop, so no descendant walk is needed
+        rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim,
+                                                       fields=['SnapNum'])
+        rootrow = load_sublink._one_hop_row(rownum, chunknum, sim,
+                                            'RootDescendantID')
+        main_size = int(sim.loaded['SubLink' + str(chunknum)]
+                        ['SnapNum'][rootrow]) + 1
+    main_buf = [np.empty(main_size, dtype=dt) for dt in dtypes]
+    incoming_buf = [np.empty(size, dtype=dt) for dt in dtypes]
+    nmain = nincoming = size
     while len(result[0]):
-        main_halos['GrNr'].insert(0, result[0][0])
-        main_halos['SnapNum'].insert(0, result[1][0])
-        main_halos['Group_M_TopHat200'].insert(0, result[2][0])
+        nmain -= 1
+        for buf, arr in zip(main_buf, result):
+            buf[nmain] = arr[0]
         if len(result[0]) > 1 and result[2][1] >= mass_ratio_thr * result[2][0]:
-            incoming_halos['GrNr'].insert(0, result[0][1])
-            incoming_halos['SnapNum'].insert(0, result[1][1])
-            incoming_halos['Group_M_TopHat200'].insert(0, result[2][1])
+            nincoming -= 1
+            for buf, arr in zip(incoming_buf, result):
+                buf[nincoming] = arr[1]
         head = result[3][0]
         result = _immediate_progenitor_halos(head, sim)
 
-    if not track_descendants:
-        for k in main_halos.keys():
-            main_halos[k] = np.array(main_halos[k])
-            incoming_halos[k] = np.array(incoming_halos[k])
-        return main_halos, incoming_halos
-
-    head = subhaloid
-    result = _immediate_descendant_halo(head, sim)
-    while len(result[0]):
-        backcheck = _immediate_progenitor_halos(result[3][0], sim)
-        if headgroup != backcheck[0][0]:
-            break
-        main_halos['GrNr'].append(result[0][0])
-        main_halos['SnapNum'].append(result[1][0])
-        main_halos['Group_M_TopHat200'].append(result[2][0])
-        head = result[3][0]
-        headgroup = result[0][0]
+    nend = size
+    if track_descendants:
+        head = subhaloid
         result = _immediate_descendant_halo(head, sim)
-
-    for k in main_halos.keys():
-        main_halos[k] = np.array(main_halos[k])
-        incoming_halos[k] = np.array(incoming_halos[k])
+        while len(result[0]):
+            backcheck = _immediate_progenitor_halos(result[3][0], sim)
+            if headgroup != backcheck[0][0]:
+                break
+            for buf, arr in zip(main_buf, result):
+                buf[nend] = arr[0]
+            nend += 1
+            head = result[3][0]
+            headgroup = result[0][0]
+            result = _immediate_descendant_halo(head, sim)
+
+    main_halos = {k: buf[nmain:nend] for k, buf in zip(keys, main_buf)}
+    incoming_halos = {k: buf[nincoming:]
+                      for k, buf in zip(keys, incoming_buf)}
     return main_halos, incoming_halos
+
+
+def main_merger_trees(subhaloids, sim,
+                      mass_ratio_thr=0, track_descendants=False,
+                      max_workers=1):
+    """ Constructs the main merger trees of many subhalos, with
+    `halo_tree.main_merger_tree`. The tree columns of all the chunks
+    involved are loaded up front, so that the walks only read from the
+    loaded catalogs and can run in threads.
+
+    Parameters
+    ----------
+    subhaloids : array_like
+      The SubhaloIDs of the subhalos whose main merger trees to construct.
+      Subhalos can be in different chunks.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies
+      the simulation box to work with.
+
+    mass_ratio_thr : float, optional
+      Passed on to `halo_tree.main_merger_tree`. Default is 0.
+
+    track_descendants : bool, optional
+      Passed on to `halo_tree.main_merger_tree`. Default is False.
+
+    max_workers : int, optional
+      The number of threads to run the walks in. Default is 1, in which
+      case the walks run one after another in the calling thread.
+
+    Returns
+    -------
+    trees : list of tuple
+      The (main_halos, incoming_halos) output of
+      `halo_tree.main_merger_tree` for each of the given subhalos, in the
+      same order.
+
+    """
+
+    subhaloids = np.atleast_1d(subhaloids)
+    fields = ['SubhaloID', 'SnapNum', 'SubhaloGrNr', 'Group_M_TopHat200',
+              'GroupMass', 'FirstProgenitorID', 'NextProgenitorID',
+              'DescendantID', 'RootDescendantID',
+              'FirstSubhaloInFOFGroupID', 'NextSubhaloInFOFGroupID']
+    chunknums = np.unique(locate_object.chunk_num(subhaloids)[0])
+
+    # Pinned so that a memory limit on sim cannot evict the chunks while
+    # the walks read them, and pinned before loading so that the later
+    # chunks do not evict the earlier ones
+    pinned = [key for key in ('SubLink' + str(cn) for cn in chunknums)
+              if key not in sim.pinned]
+    sim.pin(pinned)
+    try:
+        for chunknum in chunknums:
+            sim.load_by_file('SubLink', chunknum, fields)
+
+        walk = functools.partial(main_merger_tree, sim=sim,
+                                 mass_ratio_thr=mass_ratio_thr,
+                                 track_descendants=track_descendants)
+        if max_workers == 1:
+            return [walk(subhaloid) for subhaloid in subhaloids]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(walk, subhaloids))
+    finally:
+        sim.unpin(pinned)
@@ -7,6 +7,38 @@ import numpy as np
 
 import locate_object
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the walks then run in Python
+    njit = None
+
+# Pointers followed until -1, and pointers that jump straight to the end
+_iter_pointers = ['FirstProgenitorID', 'NextProgenitorID',
+                  'DescendantID', 'NextSubhaloInFOFGroupID']
+_noniter_pointers = ['LastProgenitorID', 'MainLeafProgenitorID',
+                     'RootDescendantID', 'FirstSubhaloInFOFGroupID']
+_noniter_pointer_set = frozenset(_noniter_pointers)
+
+# Columns the loaders need on top of the requested fields
+_walk_fields = {pointer: frozenset({pointer, 'SubhaloID'})
+                for pointer in _iter_pointers + _noniter_pointers}
+_id_fields = frozenset({'SubhaloID'})
+_progenitor_batch_fields = frozenset({'SubhaloID', 'FirstProgenitorID',
+                                      'NextProgenitorID'})
+_descendant_batch_fields = frozenset({'SubhaloID', 'DescendantID'})
+_tree_progenitor_fields = frozenset({'SubhaloID', 'MainLeafProgenitorID',
+                                     'LastProgenitorID'})
+_tree_descendant_fields = frozenset({'SubhaloID', 'DescendantID',
+                                     'RootDescendantID', 'SnapNum'})
+
+
+def _with_fields(fields, required):
+    # The requested fields followed by the missing required ones, in a
+    # fixed order, reusing fields if it has them all
+    if required.issubset(fields):
+        return fields
+    return [*fields, *sorted(required.difference(fields))]
+
 
 def load_single_subhalo(subhaloid, fields, sim, internal=False):
     """ Loads specified columns in the SubLink catalog for a given subhalo.
@@ -47,16 +79,106 @@ def load_single_subhalo(subhaloid, fields, sim, internal=False):
         rownum, chunknum = locate_object.row_in_chunk(subhaloid, sim)
     catkey = 'SubLink' + str(chunknum)
     sim.load_by_file('SubLink', chunknum, fields)
+    cat = sim.loaded[catkey]
 
     subhalo = {'Number': len(subhaloid),
                'ChunkNumber': chunknum,
                'IndexInChunk': rownum}
     for field in fields:
-        subhalo[field] = sim.loaded[catkey][field][rownum]
+        subhalo[field] = cat[field][rownum]
 
     return subhalo
 
 
+def _walk_iter(pointer_col, row, head, numlimit):
+    # Rows visited by following an iterative pointer from the given row,
+    # whose SubhaloID is head, until the pointer is -1 or numlimit rows
+    # are collected. SubhaloIDs are contiguous within a tree, so the row
+    # of any subhalo a pointer leads to is its ID offset by row - head
+    base = row - head
+    idx = [row]
+    while True:
+        row = base + pointer_col[row]
+        if row < 0:
+            break
+        idx.append(row)
+        if numlimit and len(idx) == numlimit:
+            break
+    return np.array(idx)
+
+
+if njit is not None:
+    _walk_iter = njit(cache=True)(_walk_iter)
+
+
+def _walk_iter_batch(pointer_col, subhaloid_col, rows, numlimit):
+    # _walk_iter from each of the given rows, with all walks advanced in
+    # lockstep by one vectorised hop. Returns the visited rows grouped by
+    # walk, each in walk order, and the number of rows in each walk
+    steps = [rows]
+    walks = [np.arange(len(rows))]
+    bases = rows - subhaloid_col[rows]
+    active = walks[0]
+    count = 1
+    while len(rows):
+        rows = bases[active] + pointer_col[rows]
+        alive = rows >= 0
+        rows = rows[alive]
+        active = active[alive]
+        steps.append(rows)
+        walks.append(active)
+        count += 1
+        if numlimit and count == numlimit:
+            break
+    owner = np.concatenate(walks)
+    order = np.argsort(owner, kind='stable')
+    counts = np.bincount(owner, minlength=len(walks[0]))
+    return np.concatenate(steps)[order], counts
+
+
+# Row step of the pointers that mostly move to an adjacent row: the first
+# progenitor is always the next row, a main branch descendant the previous
+_run_steps = {'FirstProgenitorID': 1, 'DescendantID': -1}
+
+
+def _walk_runs(pointer_col, row, head, step, probe=64):
+    # Same rows as an unlimited _walk_iter, but rows moving by step are
+    # probed a window at a time and emitted as a range, and only the jumps
+    # in between are followed singly
+    base = row - head
+    runs = []
+    while True:
+        stop = max(min(row + step * probe, len(pointer_col)), -1)
+        rows = np.arange(row, stop, step)
+        nexts = base + pointer_col[rows]
+        breaks = np.flatnonzero((nexts != rows + step) | (nexts < 0))
+        if len(breaks) == 0:
+            runs.append(rows)
+            row = rows[-1] + step
+            continue
+        end = breaks[0]
+        runs.append(rows[:end + 1])
+        if nexts[end] < 0:
+            break
+        row = nexts[end]
+    return runs
+
+
+def _run_slice(start, end):
+    # Slice over the adjacent rows from start to end inclusive, in either
+    # direction, so their fields are copied instead of fancy indexed
+    if end >= start:
+        return slice(start, end + 1)
+    return slice(start, end - 1 if end > 0 else None, -1)
+
+
+def _gather(column, rows):
+    # column[rows], as a copy also when rows is a slice
+    if isinstance(rows, slice):
+        return column[rows].copy()
+    return column[rows]
+
+
 def walk_tree(subhaloid, fields, sim, pointer, numlimit=0):
     """ Walks the SubLink tree following a given pointer (e.g., DescendantID,
     FirstProgenitorID, etc.) iteratively, starting from the given subhalo,
@@ -98,50 +220,139 @@ def walk_tree(subhaloid, fields, sim, pointer, numlimit=0):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    iter_pointers = ['FirstProgenitorID', 'NextProgenitorID',
-                     'DescendantID', 'NextSubhaloInFOFGroupID']
-    noniter_pointers = ['LastProgenitorID', 'MainLeafProgenitorID',
-                        'RootDescendantID', 'FirstSubhaloInFOFGroupID']
-
-    if pointer not in iter_pointers + noniter_pointers:
+    if pointer not in _walk_fields:
         raise ValueError('Unknown pointer: {}. '.format(pointer) +
-                         'Choose from {}.'.format(iter_pointers +
-                                                  noniter_pointers))
+                         'Choose from {}.'.format(_iter_pointers +
+                                                  _noniter_pointers))
 
-    fields_ = list(set(fields).union({pointer, 'SubhaloID'}))
-    subhalo = load_single_subhalo(subhaloid, fields_, sim, internal=True)
-    chunknum = subhalo['ChunkNumber']
-    rownum = subhalo['IndexInChunk'][0]
-    catkey = 'SubLink' + str(chunknum)
+    rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim)
+    return _walk_from_row(rownum, chunknum, fields, sim, pointer,
+                          numlimit=numlimit)
+
+
+def _one_hop_row(rownum, chunknum, sim, pointer):
+    # Row that a one-hop pointer leads to from the given row, without
+    # building a chain
+    sim.load_by_file('SubLink', chunknum, [pointer, 'SubhaloID'])
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    return rownum + (cat[pointer][rownum] - cat['SubhaloID'][rownum])
 
-    head = subhalo['SubhaloID'][0]
-    head_row = rownum
-    idx = [head_row]
 
-    if pointer in noniter_pointers:
-        jump = sim.loaded[catkey][pointer][head_row] - head
+def _walk_from_row(rownum, chunknum, fields, sim, pointer, numlimit=0):
+    # walk_tree from a subhalo whose row in the chunk is already known,
+    # e.g. from the end of a previous walk, without locating it again
+    fields_ = _with_fields(fields, _walk_fields[pointer])
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    pointer_col = cat[pointer]
+    head = cat['SubhaloID'][rownum]
+
+    if pointer in _noniter_pointer_set:
+        jump = pointer_col[rownum] - head
         if jump != 0:
-            head_row += jump
-            idx.append(head_row)
+            idx = np.array([rownum, rownum + jump])
+        else:
+            idx = np.array([rownum])
+        rows = idx
+
+    elif pointer in _run_steps and not numlimit:
+        runs = _walk_runs(pointer_col, rownum, head, _run_steps[pointer])
+        idx = np.concatenate(runs)
+        # Main branch walks are usually a single run
+        if len(runs) == 1:
+            rows = _run_slice(idx[0], idx[-1])
+        else:
+            rows = idx
 
     else:
-        while True:
-            jump = sim.loaded[catkey][pointer][head_row] - head
-            head_row += jump
-            if head_row < 0:
-                break
-            idx.append(head_row)
-            if numlimit and len(idx) == numlimit:
-                break
-            head = sim.loaded[catkey]['SubhaloID'][head_row]
+        idx = _walk_iter(pointer_col, rownum, head, numlimit)
+        rows = idx
     chain = {'Number': len(idx),
              'ChunkNumber': chunknum,
-             'IndexInChunk': np.array(idx)}
+             'IndexInChunk': idx}
     for field in fields:
-        chain[field] = sim.loaded[catkey][field][idx]
+        chain[field] = _gather(cat[field], rows)
     return chain
 
 
+def walk_tree_batch(subhaloids, fields, sim, pointer, numlimit=0):
+    """ Walks the SubLink tree following a given pointer from each of the
+    given subhalos, as `load_sublink.walk_tree` does for one subhalo, with
+    the subhalos located and the fields gathered once for all the walks.
+
+    Parameters
+    ----------
+    subhaloids : array_like
+      The SubhaloIDs of the subhalos to start from. SubhaloID is the SubLink
+      index and is unique throughout all snapshots. Subhalos required to be
+      in the same chunk.
+
+    fields : list of str
+      The columns to load from the table.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies
+      the simulation box to work with.
+
+    pointer : str
+      The name of the pointer to follow. Choose from the given set of pointer
+      names in https://www.tng-project.org/data/docs/specifications/#sec4a.
+
+    numlimit : int, optional
+      The maximum number of subhalos to load along the pointer direction
+      for each walk, including the starting point. Default is 0, in which
+      case each walk follows the pointer until there are no more subhalos
+      ahead.
+
+    Returns
+    -------
+    chains : dict
+        Dictionary containing the specified fields for the chains of
+        subhalos, concatenated in the order of the input subhalos, each
+        ordered in the direction of the pointer. The chain of the i-th
+        subhalo is stored between Offsets[i] and Offsets[i + 1]. Entries
+        are stored as numpy arrays. Also includes the total number of
+        subhalos, the SubLink chunk number in which the subhalos are stored,
+        and the row indices of the loaded subhalos in the chunk.
+
+    """
+
+    if pointer not in _walk_fields:
+        raise ValueError('Unknown pointer: {}. '.format(pointer) +
+                         'Choose from {}.'.format(_iter_pointers +
+                                                  _noniter_pointers))
+
+    subhaloids = np.atleast_1d(subhaloids)
+    rownum, chunknum = locate_object._row_in_chunk(subhaloids, sim)
+    fields_ = _with_fields(fields, _walk_fields[pointer])
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    pointer_col = cat[pointer]
+    subhaloid_col = cat['SubhaloID']
+
+    if pointer in _noniter_pointer_set:
+        ends = rownum + (pointer_col[rownum] - subhaloid_col[rownum])
+        keep = np.stack([np.ones(len(rownum), dtype=bool),
+                         ends != rownum], axis=1)
+        idx = np.stack([rownum, ends], axis=1)[keep]
+        counts = keep.sum(axis=1)
+
+    else:
+        idx, counts = _walk_iter_batch(pointer_col, subhaloid_col,
+                                       rownum, numlimit)
+
+    offsets = np.zeros(len(rownum) + 1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+
+    chains = {'Number': len(idx),
+              'ChunkNumber': chunknum,
+              'IndexInChunk': idx,
+              'Offsets': offsets}
+    for field in fields:
+        chains[field] = cat[field][idx]
+    return chains
+
+
 def load_group_subhalos(subhaloid, fields, sim, numlimit=0):
     """ Loads specified columns in the SubLink catalog for all subhalos in
     the same FOF group as the given subhalo, ordered by the MassHistory
@@ -180,12 +391,12 @@ def load_group_subhalos(subhaloid, fields, sim, numlimit=0):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    fields_ = list(set(fields).union({'SubhaloID'}))
-    primary_subhaloid = walk_tree(subhaloid, fields_, sim,
-                                  'FirstSubhaloInFOFGroupID')['SubhaloID'][-1]
+    rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim)
+    primary_row = _one_hop_row(rownum, chunknum, sim,
+                               'FirstSubhaloInFOFGroupID')
 
-    groupsubs = walk_tree(primary_subhaloid, fields, sim,
-                          'NextSubhaloInFOFGroupID', numlimit=numlimit)
+    groupsubs = _walk_from_row(primary_row, chunknum, fields, sim,
+                               'NextSubhaloInFOFGroupID', numlimit=numlimit)
 
     return groupsubs
 
@@ -222,7 +433,7 @@ def load_immediate_progenitors(subhaloid, fields, sim):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    fields_ = list(set(fields).union({'SubhaloID'}))
+    fields_ = _with_fields(fields, _id_fields)
     firstprogenitor = walk_tree(subhaloid, fields_, sim,
                                 'FirstProgenitorID', numlimit=2)
     if firstprogenitor['SubhaloID'][-1] == subhaloid:
@@ -234,9 +445,72 @@ def load_immediate_progenitors(subhaloid, fields, sim):
                                                     dtype=firstprogenitor[field].dtype)
         return immediate_progenitors
 
-    immediate_progenitors = walk_tree(firstprogenitor['SubhaloID'][-1],
-                                      fields, sim,
-                                      'NextProgenitorID')
+    immediate_progenitors = _walk_from_row(firstprogenitor['IndexInChunk'][-1],
+                                           firstprogenitor['ChunkNumber'],
+                                           fields, sim, 'NextProgenitorID')
+
+    return immediate_progenitors
+
+
+def load_immediate_progenitors_batch(subhaloids, fields, sim):
+    """ Loads specified columns in the SubLink catalog for the immediate
+    progenitors of all the given subhalos at once. Gives the same result
+    as merging `load_sublink.load_immediate_progenitors` of each subhalo
+    with `load_sublink.merge_tree_dicts`, but follows the pointers of all
+    subhalos together instead of one subhalo at a time.
+
+    Parameters
+    ----------
+    subhaloids : array_like
+      The SubhaloIDs of the subhalos whose progenitors to load. SubhaloID
+      is the ID assigned by SubLink and is unique throughout all snapshots.
+      Subhalos required to be in the same chunk.
+
+    fields : list of str
+      The columns to load from the table.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies
+      the simulation box to work with.
+
+    Returns
+    -------
+    immediate_progenitors : dict
+        Dictionary containing the specified fields for the immediate
+        progenitors of all the given subhalos. Subhalos are sorted by
+        SubhaloID. Entries are stored as numpy arrays. Also includes the
+        number of subhalos, the SubLink chunk number in which the subhalos
+        are stored, and the row indices of the loaded subhalos in the chunk.
+
+    """
+
+    subhaloids = np.atleast_1d(subhaloids)
+    rownum, chunknum = locate_object._row_in_chunk(subhaloids, sim)
+    catkey = 'SubLink' + str(chunknum)
+    fields_ = _with_fields(fields, _progenitor_batch_fields)
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded[catkey]
+    subhaloid_col = cat['SubhaloID']
+
+    firstprogenitor = cat['FirstProgenitorID'][rownum]
+    has_progenitor = firstprogenitor != -1
+    rows = rownum[has_progenitor]
+    rows = rows + (firstprogenitor[has_progenitor] - subhaloid_col[rows])
+    idx = [rows]
+    nextprogenitor_col = cat['NextProgenitorID']
+    while len(rows):
+        nextprogenitor = nextprogenitor_col[rows]
+        has_next = nextprogenitor != -1
+        rows = rows[has_next]
+        rows = rows + (nextprogenitor[has_next] - subhaloid_col[rows])
+        idx.append(rows)
+    idx = np.unique(np.concatenate(idx))
+
+    immediate_progenitors = {'Number': len(idx),
+                             'ChunkNumber': chunknum,
+                             'IndexInChunk': idx}
+    for field in fields:
+        immediate_progenitors[field] = cat[field][idx]
 
     return immediate_progenitors
 
@@ -272,27 +546,87 @@ def load_immediate_descendant(subhaloid, fields, sim):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    fields_ = list(set(fields).union({'SubhaloID'}))
-    descendant = walk_tree(subhaloid, fields_, sim,
-                           'DescendantID', numlimit=2)
-    if descendant['SubhaloID'][-1] == subhaloid:
+    rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim)
+    fields_ = _with_fields(fields, _descendant_batch_fields)
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+
+    # A single hop, read directly instead of walked
+    descendantid = cat['DescendantID'][rownum]
+    if descendantid == -1:
         immediate_descendant = {'Number': 0,
-                                'ChunkNumber': descendant['ChunkNumber'],
+                                'ChunkNumber': chunknum,
                                 'IndexInChunk': np.array([], dtype='int64')}
         for field in fields:
             immediate_descendant[field] = np.array([],
-                                                   dtype=descendant[field].dtype)
+                                                   dtype=cat[field].dtype)
         return immediate_descendant
 
+    idx = np.array([rownum + (descendantid - cat['SubhaloID'][rownum])])
     immediate_descendant = {'Number': 1,
-                            'ChunkNumber': descendant['ChunkNumber'],
-                            'IndexInChunk': descendant['IndexInChunk'][1:]}
+                            'ChunkNumber': chunknum,
+                            'IndexInChunk': idx}
     for field in fields:
-        immediate_descendant[field] = descendant[field][1:]
+        immediate_descendant[field] = cat[field][idx]
 
     return immediate_descendant
 
 
+def load_immediate_descendants_batch(subhaloids, fields, sim):
+    """ Loads specified columns in the SubLink catalog for the immediate
+    descendants of all the given subhalos at once. Gives the same result
+    as merging `load_sublink.load_immediate_descendant` of each subhalo
+    with `load_sublink.merge_tree_dicts`, but follows the pointers of all
+    subhalos together instead of one subhalo at a time.
+
+    Parameters
+    ----------
+    subhaloids : array_like
+      The SubhaloIDs of the subhalos whose descendants to load. SubhaloID
+      is the ID assigned by SubLink and is unique throughout all snapshots.
+      Subhalos required to be in the same chunk.
+
+    fields : list of str
+      The columns to load from the table.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies
+      the simulation box to work with.
+
+    Returns
+    -------
+    immediate_descendants : dict
+        Dictionary containing the specified fields for the immediate
+        descendants of all the given subhalos. Subhalos are sorted by
+        SubhaloID. Entries are stored as numpy arrays. Also includes the
+        number of subhalos, the SubLink chunk number in which the subhalos
+        are stored, and the row indices of the loaded subhalos in the chunk.
+
+    """
+
+    subhaloids = np.atleast_1d(subhaloids)
+    rownum, chunknum = locate_object._row_in_chunk(subhaloids, sim)
+    catkey = 'SubLink' + str(chunknum)
+    fields_ = _with_fields(fields, _descendant_batch_fields)
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded[catkey]
+
+    descendant = cat['DescendantID'][rownum]
+    has_descendant = descendant != -1
+    rows = rownum[has_descendant]
+    rows = rows + (descendant[has_descendant] -
+                   cat['SubhaloID'][rows])
+    idx = np.unique(rows)
+
+    immediate_descendants = {'Number': len(idx),
+                             'ChunkNumber': chunknum,
+                             'IndexInChunk': idx}
+    for field in fields:
+        immediate_descendants[field] = cat[field][idx]
+
+    return immediate_descendants
+
+
 def load_tree_progenitors(subhaloid, fields, sim, main_branch_only=False):
     """ Loads specified columns in the SubLink catalog for the progenitors
     of the given subhalo.
@@ -330,25 +664,24 @@ def load_tree_progenitors(subhaloid, fields, sim, main_branch_only=False):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    fields_ = list(set(fields).union({'MainLeafProgenitorID', 'LastProgenitorID', 'SubhaloID'}))
-    subhalo = load_single_subhalo(subhaloid, fields_, sim, internal=True)
-    chunknum = subhalo['ChunkNumber']
-    rownum = subhalo['IndexInChunk'][0]
-    catkey = 'SubLink' + str(chunknum)
+    rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim)
+    fields_ = _with_fields(fields, _tree_progenitor_fields)
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded['SubLink' + str(chunknum)]
 
     start = rownum
     if main_branch_only:
-        end = rownum + (subhalo['MainLeafProgenitorID'][0] -
-                        subhalo['SubhaloID'][0])
+        end = rownum + (cat['MainLeafProgenitorID'][rownum] -
+                        cat['SubhaloID'][rownum])
     else:
-        end = rownum + (subhalo['LastProgenitorID'][0] -
-                        subhalo['SubhaloID'][0])
+        end = rownum + (cat['LastProgenitorID'][rownum] -
+                        cat['SubhaloID'][rownum])
 
     progenitors = {'Number': end - start + 1,
                    'ChunkNumber': chunknum,
                    'IndexInChunk': np.arange(start, end + 1)}
     for field in fields:
-        progenitors[field] = sim.loaded[catkey][field][start:end + 1]
+        progenitors[field] = cat[field][start:end + 1]
     return progenitors
 
 
@@ -417,18 +750,36 @@ def load_tree_descendants(subhaloid, fields, sim, main_branch_only=True):
     if not np.isscalar(subhaloid):
         raise TypeError('Process one subhalo at a time.')
 
-    descendants = walk_tree(subhaloid, fields, sim, 'DescendantID')
-
-    if main_branch_only:
-        not_main_branch = (descendants['IndexInChunk'][:-1] - 1 !=
-                           descendants['IndexInChunk'][1:])
-        if np.any(not_main_branch):
-            truncate = np.where(not_main_branch)[0][0]
-            descendants['Number'] = truncate + 1
-            descendants['IndexInChunk'] = (descendants['IndexInChunk']
-                                                      [:truncate + 1])
-            for field in fields:
-                descendants[field] = descendants[field][:truncate + 1]
+    if not main_branch_only:
+        return walk_tree(subhaloid, fields, sim, 'DescendantID')
+
+    rownum, chunknum = locate_object._row_in_chunk(subhaloid, sim)
+    fields_ = _with_fields(fields, _tree_descendant_fields)
+    sim.load_by_file('SubLink', chunknum, fields_)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    subhaloid_col = cat['SubhaloID']
+    snapnum_col = cat['SnapNum']
+
+    # A main branch descendant is always in the row right before its first
+    # progenitor, so the main branch descendants are consecutive rows above
+    # the subhalo, at most one per snapshot up to the root descendant. They
+    # are checked in one pass instead of walked.
+    root_row = rownum + (cat['RootDescendantID'][rownum] -
+                         subhaloid_col[rownum])
+    low = max(root_row,
+              rownum - (snapnum_col[root_row] - snapnum_col[rownum]))
+    rows = np.arange(rownum, low - 1, -1)
+    off_branch = np.flatnonzero(cat['DescendantID'][rows[:-1]] -
+                                subhaloid_col[rows[:-1]] != -1)
+    if len(off_branch):
+        rows = rows[:off_branch[0] + 1]
+
+    descendants = {'Number': len(rows),
+                   'ChunkNumber': chunknum,
+                   'IndexInChunk': rows}
+    rows = _run_slice(rows[0], rows[-1])
+    for field in fields:
+        descendants[field] = _gather(cat[field], rows)
 
     return descendants
 
@@ -515,13 +866,37 @@ def load_entire_tree(subhaloid, fields, sim,
 
     Notes
     -----
-    A wrapper around `merge_tree_dicts`, `load_tree_progenitors`, and
-    `load_tree_descendants`.
+    A wrapper around `load_tree_progenitors` and `load_tree_descendants`,
+    equivalent to merging their results with `merge_tree_dicts`.
 
     """
 
-    return merge_tree_dicts([load_tree_progenitors(subhaloid, fields, sim,
-                                                   progenitor_main_branch_only),
-                             load_tree_descendants(subhaloid, fields, sim,
-                                                   descendant_main_branch_only)],
-                            fields=fields)
+    progenitors = load_tree_progenitors(subhaloid, [], sim,
+                                        progenitor_main_branch_only)
+    descendants = load_tree_descendants(subhaloid, [], sim,
+                                        descendant_main_branch_only)
+    chunknum = progenitors['ChunkNumber']
+    sim.load_by_file('SubLink', chunknum, fields)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+
+    # Descendants have smaller SubhaloIDs than their progenitors, so the
+    # descendant rows reversed, less the subhalo itself, come right before
+    # the progenitor rows and the two need no sorting or deduplication.
+    # Main branch descendants are moreover the rows right above the
+    # subhalo, making the whole tree one row range.
+    if descendant_main_branch_only:
+        start = descendants['IndexInChunk'][-1]
+        end = progenitors['IndexInChunk'][-1]
+        idx = np.arange(start, end + 1)
+        rows = _run_slice(start, end)
+    else:
+        idx = np.concatenate([descendants['IndexInChunk'][:0:-1],
+                              progenitors['IndexInChunk']])
+        rows = idx
+
+    entire_tree = {'Number': len(idx),
+                   'ChunkNumber': chunknum,
+                   'IndexInChunk': idx}
+    for field in fields:
+        entire_tree[field] = _gather(cat[field], rows)
+    return entire_tree
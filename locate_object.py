@@ -7,6 +7,9 @@ import numpy as np
 
 _sl_chunk_const = 10000000000000000
 
+# Query size above which subhalos are searched for in sorted order
+_sorted_search_min = 1024
+
 
 def sublink_id(subfindid, snapnum, sim):
     """ Converts subhalo SubfindID(s) to SubhaloID(s) given the snapshot.
@@ -73,15 +76,16 @@ def chunk_num(subhaloid):
             raise ValueError('SubhaloID cannot be -1.')
         return subhaloid // _sl_chunk_const, True
 
-    chunknum = np.array(subhaloid) // _sl_chunk_const
+    subhaloid = np.asarray(subhaloid)
+    chunknum = subhaloid // _sl_chunk_const
     if np.any(subhaloid == -1):
         raise ValueError('SubhaloID cannot be -1.')
-    samechunk = len(np.unique(chunknum)) == 1
+    samechunk = bool(chunknum.size and chunknum.min() == chunknum.max())
 
     return chunknum, samechunk
 
 
-def row_in_chunk(subhaloid, sim, tolerate_non_existence=False):
+def row_in_chunk(subhaloid, sim, tolerate_non_existence=False, fields=()):
     """ Locates subhalo(s) within a tree file chunk.
 
     Parameters
@@ -99,6 +103,10 @@ def row_in_chunk(subhaloid, sim, tolerate_non_existence=False):
       If False (default), raise ValueError, if True, return wrong rownum for
       that subhalo, but print out its SubhaloID.
 
+    fields : list of str, optional
+      Further columns to load from the tree chunk together with SubhaloID,
+      for callers that read them at the returned rows. Default is none.
+
     Returns
     -------
     rownum : int or array_like
@@ -120,16 +128,16 @@ def row_in_chunk(subhaloid, sim, tolerate_non_existence=False):
                                                            return_index=True)[1])[1]))
     if not np.isscalar(chunknum):
         chunknum = chunknum[0]
-    sim.load_by_file('SubLink', chunknum, fields=['SubhaloID'])
-    rownum = np.searchsorted(sim.loaded['SubLink' + str(chunknum)]
-                                       ['SubhaloID'],
-                             subhaloid)
-    if np.any(subhaloid != sim.loaded['SubLink' + str(chunknum)]
-                                     ['SubhaloID'][rownum]):
+    sim.load_by_file('SubLink', chunknum, fields=['SubhaloID', *fields])
+    subhaloid_col = sim.loaded['SubLink' + str(chunknum)]['SubhaloID']
+    rownum = _search_rows(subhaloid_col, subhaloid)
+    # IDs past the last subhalo get rownum == len(subhaloid_col), which is
+    # clipped for the comparison so that they count as missing too
+    missing = subhaloid != subhaloid_col.take(rownum, mode='clip')
+    if np.any(missing):
         if tolerate_non_existence:
             print('SubhaloID(s) not present in tree: ',
-                  subhaloid[subhaloid != sim.loaded['SubLink' + str(chunknum)]
-                                                   ['SubhaloID'][rownum]])
+                  subhaloid[missing])
         else:
             raise ValueError('Some of the SubhaloIDs do not exist in the tree.' +
                              'This would sometimes occur if a subhalo does not ' +
@@ -139,18 +147,73 @@ def row_in_chunk(subhaloid, sim, tolerate_non_existence=False):
     return rownum, chunknum
 
 
+def rows_in_chunks(subhaloid, sim):
+    """ Locates subhalos that can be spread over several tree file chunks,
+    with one vectorized search per chunk.
+
+    Parameters
+    ----------
+    subhaloid : array_like
+      The SubhaloIDs of the subhalos to locate. SubhaloID is the SubLink
+      index and is unique throughout all snapshots.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies the
+      simulation box to work with.
+
+    Returns
+    -------
+    rownum : array_like
+      The row indices of the given subhalos in their tree chunks. Has same
+      shape as the input subhaloid.
+
+    chunknum : array_like
+      The SubLink chunk numbers of the given subhalos. Has same shape as
+      the input subhaloid.
+
+    """
+
+    subhaloid = np.asarray(subhaloid)
+    if np.any(subhaloid == -1):
+        raise ValueError('SubhaloID cannot be -1.')
+    chunknum = subhaloid // _sl_chunk_const
+    rownum = np.empty(subhaloid.shape, dtype=np.intp)
+    for cn in np.unique(chunknum):
+        in_chunk = chunknum == cn
+        rownum[in_chunk] = row_in_chunk(subhaloid[in_chunk], sim)[0]
+
+    return rownum, chunknum
+
+
+def _search_rows(subhaloid_col, subhaloid):
+    # Rows of the given SubhaloIDs in the sorted SubhaloID column. If the
+    # chunk's SubhaloIDs are contiguous the rows are plain offsets from the
+    # first one. Otherwise large queries are searched in sorted order, so
+    # consecutive binary searches share their path through the column,
+    # and scattered back
+    first = subhaloid_col[0]
+    if subhaloid_col[-1] - first == len(subhaloid_col) - 1:
+        return np.subtract(subhaloid, first)
+    if np.ndim(subhaloid) != 1 or len(subhaloid) <= _sorted_search_min:
+        return np.searchsorted(subhaloid_col, subhaloid)
+    order = np.argsort(subhaloid)
+    rownum = np.empty(len(order), dtype=np.intp)
+    rownum[order] = np.searchsorted(subhaloid_col, np.take(subhaloid, order))
+    return rownum
+
+
 def _chunk_num(subhaloid):
     if np.isscalar(subhaloid):
         return subhaloid // _sl_chunk_const
     return subhaloid[0] // _sl_chunk_const
 
 
-def _row_in_chunk(subhaloid, sim):
+def _row_in_chunk(subhaloid, sim, fields=()):
     chunknum = _chunk_num(subhaloid)
-    sim.load_by_file('SubLink', chunknum, fields=['SubhaloID'])
-    rownum = np.searchsorted(sim.loaded['SubLink' + str(chunknum)]
-                                       ['SubhaloID'],
-                             subhaloid)
+    sim.load_by_file('SubLink', chunknum, fields=['SubhaloID', *fields])
+    rownum = _search_rows(sim.loaded['SubLink' + str(chunknum)]
+                                    ['SubhaloID'],
+                          subhaloid)
     return rownum, chunknum
 
 
@@ -185,14 +248,65 @@ def subfind_id(subhaloid, sim, internal=False):
 
     """
 
+    fields = ['SubfindID', 'SnapNum']
     if internal:
-        rownum, chunknum = _row_in_chunk(subhaloid, sim)
+        rownum, chunknum = _row_in_chunk(subhaloid, sim, fields=fields)
     else:
-        rownum, chunknum = row_in_chunk(subhaloid, sim)
-    sim.load_by_file('SubLink', chunknum,
-                     fields=['SubfindID', 'SnapNum'])
-    subfindid = sim.loaded['SubLink' + str(chunknum)]['SubfindID'][rownum]
-    snapnum = sim.loaded['SubLink' + str(chunknum)]['SnapNum'][rownum]
+        rownum, chunknum = row_in_chunk(subhaloid, sim, fields=fields)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    subfindid = cat['SubfindID'][rownum]
+    snapnum = cat['SnapNum'][rownum]
+
+    return subfindid, snapnum
+
+
+def subfind_id_many(subhaloid, sim):
+    """ Converts SubhaloIDs that can be spread over several tree file chunks
+    to SubfindIDs and SnapNums, with one search per chunk.
+
+    Parameters
+    ----------
+    subhaloid : array_like
+      The SubhaloIDs of the subhalos to convert. SubhaloID is the SubLink
+      index and is unique throughout all snapshots.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies the
+      simulation box to work with.
+
+    Returns
+    -------
+    subfindid : array_like
+      The SubfindIDs of the given subhalos. SubfindID is only unique within
+      each snapshot and not throughout the history. Has same shape as the
+      input subhaloid.
+
+    snapnum : array_like
+      The snapshot numbers of the subhalos. Has same shape as the input
+      subhaloid.
+
+    """
+
+    rownum, chunknum = rows_in_chunks(subhaloid, sim)
+
+    # Gathered per chunk first, so that the outputs take the data types of
+    # the loaded columns, which load_by_file may have cast
+    in_chunks, subfindids, snapnums = [], [], []
+    for cn in np.unique(chunknum):
+        in_chunk = chunknum == cn
+        sim.load_by_file('SubLink', cn, fields=['SubfindID', 'SnapNum'])
+        cat = sim.loaded['SubLink' + str(cn)]
+        in_chunks.append(in_chunk)
+        subfindids.append(cat['SubfindID'][rownum[in_chunk]])
+        snapnums.append(cat['SnapNum'][rownum[in_chunk]])
+
+    subfindid = np.empty(rownum.shape, dtype=np.result_type(*subfindids)
+                         if subfindids else np.intp)
+    snapnum = np.empty(rownum.shape, dtype=np.result_type(*snapnums)
+                       if snapnums else np.intp)
+    for in_chunk, sfid, sn in zip(in_chunks, subfindids, snapnums):
+        subfindid[in_chunk] = sfid
+        snapnum[in_chunk] = sn
 
     return subfindid, snapnum
 
@@ -263,9 +377,8 @@ def sublink_central(groupnum, snapnum, sim):
     """
     subfindcen = sublink_id(subfind_central(groupnum, snapnum, sim),
                             snapnum, sim)
-    rownum, chunknum = row_in_chunk(subfindcen, sim)
-    sim.load_by_file('SubLink', chunknum,
-                     fields=['FirstSubhaloInFOFGroupID'])
+    rownum, chunknum = row_in_chunk(subfindcen, sim,
+                                    fields=['FirstSubhaloInFOFGroupID'])
     sublinkcen = (sim.loaded['SubLink' + str(chunknum)]
                             ['FirstSubhaloInFOFGroupID'][rownum])
 
@@ -302,14 +415,14 @@ def group_num(subhaloid, sim, internal=False):
 
     """
 
+    fields = ['SubhaloGrNr', 'SnapNum']
     if internal:
-        rownum, chunknum = _row_in_chunk(subhaloid, sim)
+        rownum, chunknum = _row_in_chunk(subhaloid, sim, fields=fields)
     else:
-        rownum, chunknum = row_in_chunk(subhaloid, sim)
-    sim.load_by_file('SubLink', chunknum,
-                     fields=['SubhaloGrNr', 'SnapNum'])
-    groupnum = sim.loaded['SubLink' + str(chunknum)]['SubhaloGrNr'][rownum]
-    snapnum = sim.loaded['SubLink' + str(chunknum)]['SnapNum'][rownum]
+        rownum, chunknum = row_in_chunk(subhaloid, sim, fields=fields)
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    groupnum = cat['SubhaloGrNr'][rownum]
+    snapnum = cat['SnapNum'][rownum]
 
     return groupnum, snapnum
 
@@ -337,11 +450,11 @@ def is_subfind_central(subhaloid, sim):
 
     """
 
-    rownum, chunknum = row_in_chunk(subhaloid, sim)
-    sim.load_by_file('SubLink', chunknum,
-                     fields=['SubfindID', 'GroupFirstSub'])
-    subfindid = sim.loaded['SubLink' + str(chunknum)]['SubfindID'][rownum]
-    subfindcen = sim.loaded['SubLink' + str(chunknum)]['GroupFirstSub'][rownum]
+    rownum, chunknum = row_in_chunk(subhaloid, sim,
+                                    fields=['SubfindID', 'GroupFirstSub'])
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    subfindid = cat['SubfindID'][rownum]
+    subfindcen = cat['GroupFirstSub'][rownum]
 
     return subfindid == subfindcen
 
@@ -368,11 +481,48 @@ def is_sublink_central(subhaloid, sim):
       their host FOF groups. Has same shape as the input subhaloid.
 
     """
-    rownum, chunknum = row_in_chunk(subhaloid, sim)
-    sim.load_by_file('SubLink', chunknum,
-                     fields=['SubhaloID', 'FirstSubhaloInFOFGroupID'])
-    subhaloid = sim.loaded['SubLink' + str(chunknum)]['SubhaloID'][rownum]
-    sublinkcen = (sim.loaded['SubLink' + str(chunknum)]
-                            ['FirstSubhaloInFOFGroupID'][rownum])
+    rownum, chunknum = row_in_chunk(subhaloid, sim,
+                                    fields=['FirstSubhaloInFOFGroupID'])
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    subhaloid = cat['SubhaloID'][rownum]
+    sublinkcen = cat['FirstSubhaloInFOFGroupID'][rownum]
 
     return subhaloid == sublinkcen
+
+
+def centrality(subhaloid, sim):
+    """ Checks whether subhalo(s) are the SubFind and the SubLink centrals of
+    their host FOF groups, as `locate_object.is_subfind_central` and
+    `locate_object.is_sublink_central` do, locating the subhalo(s) once.
+
+    Parameters
+    ----------
+    subhaloid : int or array_like
+      The SubhaloID(s) of the subhalos to check. SubhaloID is the ID
+      assigned by SubLink and is unique throughout all snapshots.
+
+    sim : class obj
+      Instance of the simulation_box.SimulationBox class, which specifies
+      the simulation box to work with.
+
+    Returns
+    -------
+    is_subfind_cen : bool or array_like
+      Boolean values of whether the given subhalo(s) are SubFind centrals of
+      their host FOF groups. Has same shape as the input subhaloid.
+
+    is_sublink_cen : bool or array_like
+      Boolean values of whether the given subhalo(s) are SubLink centrals of
+      their host FOF groups. Has same shape as the input subhaloid.
+
+    """
+
+    rownum, chunknum = row_in_chunk(subhaloid, sim,
+                                    fields=['SubfindID', 'GroupFirstSub',
+                                            'FirstSubhaloInFOFGroupID'])
+    cat = sim.loaded['SubLink' + str(chunknum)]
+    is_subfind_cen = cat['SubfindID'][rownum] == cat['GroupFirstSub'][rownum]
+    is_sublink_cen = (cat['SubhaloID'][rownum] ==
+                      cat['FirstSubhaloInFOFGroupID'][rownum])
+
+    return is_subfind_cen, is_sublink_cen
@@ -6,14 +6,56 @@ class used for specifying the simulation box and loading data.
 
 import numpy as np
 import h5py
+from h5py import h5s
 import os
 from packaging import version
 import gc
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 assert version.parse(h5py.__version__) >= version.parse('2.9'), \
     'h5py>=2.9.x is needed'
 
 
+def _read_dataset(dsid, dtype=None):
+    # Reads a whole dataset straight into a new array through the low-level
+    # dataset id, which skips the selection set-up of Dataset.read_direct.
+    # A dtype other than the stored one is converted by HDF5 during the read
+    arr = np.empty(dsid.shape, dtype=dsid.dtype if dtype is None else dtype)
+    if arr.size:
+        dsid.read(h5s.ALL, h5s.ALL, arr)
+    return arr
+
+
+def _file_offset(dsid):
+    # Byte offset of a contiguous dataset in its file, -1 for chunked ones
+    offset = dsid.get_offset()
+    return -1 if offset is None else offset
+
+
+def _read_from_file(f, catalog, filenum, fields, dtypes=None):
+    # Reads the given columns of one catalog from an open data file
+    if dtypes is None:
+        dtypes = {}
+
+    # The HDF5 group holding the columns is resolved once per file
+    if catalog == 'Group':
+        group = f['Groups/{}/Group'.format(filenum)]
+    elif catalog == 'SubLinkOffsets':
+        group = f['Subhalo/SubLink']
+    else:
+        group = f
+    datasets = {field: group[field].id for field in fields}
+
+    # Contiguous columns are read in file order, so that the reads advance
+    # through the file instead of seeking back and forth
+    arr_dict = {}
+    for field in sorted(datasets, key=lambda k: _file_offset(datasets[k])):
+        arr_dict[field] = _read_dataset(datasets[field], dtypes.get(field))
+    return arr_dict
+
+
 # require h5py>=2.9.x for simulation.hdf5.
 # use simulation.hdf5 for GroupFirstSub, but still use separate chunks for
 # tree, to speed up searches.
@@ -24,7 +66,8 @@ class SimulationBox:
 
     """
 
-    def __init__(self, boxsize, resolution, dark, basepath):
+    def __init__(self, boxsize, resolution, dark, basepath,
+                 max_loaded_bytes=None):
         """ Initializes the class with simulation box information, and
         checks whether the box exists.
 
@@ -45,6 +88,14 @@ class SimulationBox:
         basepath : str
           The base path where all data are stored.
 
+        max_loaded_bytes : int, optional
+          Upper limit on the memory taken by the loaded catalogs. When a load
+          goes over it, the least recently used catalogs are deleted from
+          self.loaded, except the ones just loaded and the ones kept with
+          `pin`. Catalogs that other threads read from should be pinned.
+          Default is None, in which case catalogs stay loaded until
+          `clear_loaded` is called.
+
         Returns
         -------
         None :
@@ -69,6 +120,14 @@ class SimulationBox:
         self.dark = dark
         self.basepath = basepath
         self.loaded = {}
+        self._prefetched = {}
+        self._executor = None
+        self._executor_workers = 0
+        self.max_loaded_bytes = max_loaded_bytes
+        self.pinned = set()
+        self._last_used = {}
+        self._clock = itertools.count()
+        self._lock = threading.RLock()
 
         self.columns = {'SubLinkOffsets': ['SubhaloID'],
                         'SubLink': ['SnapNum', 'SubhaloID', 'SubfindID',
@@ -82,6 +141,21 @@ class SimulationBox:
                                     'GroupPos', 'SubhaloMass'],
                         'Group': ['GroupFirstSub']}
 
+    def __getstate__(self):
+        # Locks and pending background reads cannot be pickled. The pending
+        # reads are dropped, the copy reads those files again when loaded
+        state = self.__dict__.copy()
+        state['_prefetched'] = {}
+        state['_executor'] = None
+        del state['_clock'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._clock = itertools.count(max(self._last_used.values(),
+                                          default=-1) + 1)
+        self._lock = threading.RLock()
+
     def data_path(self, catalog, filenum):
         """ Constructs the path to a data file for the specified catalog
         type and file number.
@@ -143,7 +217,7 @@ class SimulationBox:
 
         raise OSError('Invalid file path: {}'.format(fpath))
 
-    def load_by_file(self, catalog, filenum, fields=None):
+    def load_by_file(self, catalog, filenum, fields=None, dtypes=None):
         """ Loads a data catalog into a dictionary, where keys are consistent
         with TNG column names and columns are converted to numpy arrays.
 
@@ -164,6 +238,12 @@ class SimulationBox:
           The columns to load from the table. If not given, the default columns
           will be used.
 
+        dtypes : dict, optional
+          Data types to cast columns to while reading, keyed by column name,
+          e.g. {'SubhaloMass': np.float16}. Columns not in the dictionary
+          keep their stored data types. Columns that are already loaded are
+          not read or cast again.
+
         Returns
         -------
         None :
@@ -180,49 +260,243 @@ class SimulationBox:
         if isinstance(fields, str):
             fields = [fields]
 
-        if catalog + str(filenum) in self.loaded:
-            existing = set(self.loaded[catalog + str(filenum)].keys())
-            fields = list(set(fields) - existing)
-            if not fields:  # all columns already loaded
+        key = catalog + str(filenum)
+        if key in self._prefetched:
+            self._collect_prefetched(key)
+            self._evict({key})
+
+        if key in self.loaded:
+            existing = self.loaded[key]
+            if self.max_loaded_bytes is not None:
+                self._touch((key,))
+            if existing.keys() >= set(fields):  # all columns already loaded
                 return
+            fields = [field for field in dict.fromkeys(fields)
+                      if field not in existing]
         else:
-            self.loaded[catalog + str(filenum)] = {}
+            self.loaded[key] = {}
+
+        arr_dict = self._read_fields(catalog, filenum, fields, dtypes)
+
+        self.loaded.setdefault(key, {}).update(arr_dict)
+        self._evict({key})
+
+        return
 
+    def _read_fields(self, catalog, filenum, fields, dtypes=None):
+        # Reads the given columns of one data file into a dictionary
         path = self.data_path(catalog, filenum)
+        with h5py.File(path, 'r') as f:
+            return _read_from_file(f, catalog, filenum, fields, dtypes)
+
+    def load_many(self, requests, dtypes=None):
+        """ Loads several data catalogs like `load_by_file`, opening each
+        data file only once. Useful for 'Group' catalogs, which are all
+        stored in the same file.
+
+        Parameters
+        ----------
+        requests : list of tuple
+          The catalogs to load, as (catalog, filenum) or (catalog, filenum,
+          fields) tuples with the arguments of `load_by_file`.
 
-        if catalog == 'Group':
-            arr_dict = {}
+        dtypes : dict, optional
+          Data types to cast columns to while reading, keyed by column name.
+          See `load_by_file`.
+
+        Returns
+        -------
+        None :
+          Appends the loaded columns to the self.loaded dictionary, as
+          `load_by_file` does for each request.
+
+        """
+
+        # Columns still missing, grouped by the data file holding them
+        by_path = {}
+        keys = set()
+        for catalog, filenum, *fields in requests:
+            fields = fields[0] if fields else None
+            if fields is None:
+                fields = self.columns[catalog]
+            if isinstance(fields, str):
+                fields = [fields]
+
+            key = catalog + str(filenum)
+            keys.add(key)
+            if key in self._prefetched:
+                self._collect_prefetched(key)
+            existing = self.loaded.get(key, {})
+            missing = [field for field in dict.fromkeys(fields)
+                       if field not in existing]
+            if missing:
+                path = self.data_path(catalog, filenum)
+                by_path.setdefault(path, {}).setdefault(
+                    (catalog, filenum), []).extend(missing)
+
+        for path, file_requests in by_path.items():
             with h5py.File(path, 'r') as f:
-                for field in fields:
-                    arr_dict[field] = np.array(f['Groups/{}/Group/'.
-                                               format(filenum) + field])
+                for (catalog, filenum), fields in file_requests.items():
+                    arr_dict = _read_from_file(
+                        f, catalog, filenum, list(dict.fromkeys(fields)),
+                        dtypes)
+                    self.loaded.setdefault(catalog + str(filenum),
+                                           {}).update(arr_dict)
+        self._evict(keys)
 
-        else:
-            arr_dict = {}
-            if catalog == 'SubLinkOffsets':
-                with h5py.File(path, 'r') as f:
-                    for field in fields:
-                        arr_dict[field] = np.array(f['Subhalo/SubLink'][field])
-            else:
-                with h5py.File(path, 'r') as f:
-                    for field in fields:
-                        arr_dict[field] = np.array(f[field])
-
-        self.loaded[catalog + str(filenum)] = {
-            **self.loaded[catalog + str(filenum)],
-            **arr_dict}
+        return
+
+    def prefetch(self, catalog, filenums, fields=None, max_workers=4):
+        """ Starts loading data files in background threads, so that they
+        are read while the caller works on other files. A later call to
+        `load_by_file` for one of the files waits for its columns and adds
+        them to the self.loaded dictionary.
+
+        Parameters
+        ----------
+        catalog : str
+          The type of catalog to load. Should be one of 'SubLinkOffsets',
+          'SubLink', and 'Group'.
+
+        filenums : list of int
+          The numbers of the data files to load. These are the snapshot
+          numbers for 'SubLinkOffsets' and 'Group', and the chunk numbers
+          for 'SubLink'.
+
+        fields : list of str, optional
+          The columns to load from the tables. If not given, the default
+          columns will be used.
+
+        max_workers : int, optional
+          The number of files read at the same time, default is 4. The
+          background threads are shared by later calls with the same
+          max_workers, and shut down by `clear_loaded`.
 
+        Returns
+        -------
+        None :
+          Schedules the reads. Errors, e.g. from missing files, are raised
+          by the `load_by_file` call that collects the file.
+
+        """
+
+        if fields is None:
+            fields = self.columns[catalog]
+
+        if isinstance(fields, str):
+            fields = [fields]
+
+        # One pool of background threads is kept for all the prefetches
+        if self._executor is None or self._executor_workers != max_workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            self._executor_workers = max_workers
+        for filenum in filenums:
+            key = catalog + str(filenum)
+            existing = self.loaded.get(key, {})
+            missing = [field for field in dict.fromkeys(fields)
+                       if field not in existing]
+            if missing and key not in self._prefetched:
+                self._prefetched[key] = self._executor.submit(
+                    self._read_fields, catalog, filenum, missing)
+
+        return
+
+    def _collect_prefetched(self, key):
+        # Adds the columns read in the background for key to self.loaded
+        arr_dict = self._prefetched.pop(key).result()
+        self.loaded.setdefault(key, {}).update(arr_dict)
+
+    def _touch(self, keys):
+        # Marks keys as most recently used. Recency is kept apart from
+        # self.loaded, so that a catalog read in another thread is never
+        # taken out of the dictionary just to be reordered
+        with self._lock:
+            for key in keys:
+                self._last_used[key] = next(self._clock)
+
+    def _evict(self, keys):
+        # Marks keys as most recently used, then deletes the least recently
+        # used catalogs until the loaded ones fit in self.max_loaded_bytes
+        if self.max_loaded_bytes is None:
+            return
+        with self._lock:
+            self._touch(keys)
+            nbytes = {key: sum(arr.nbytes for arr in cat.values())
+                      for key, cat in self.loaded.items()}
+            total = sum(nbytes.values())
+            for key in sorted(nbytes,
+                              key=lambda k: self._last_used.get(k, -1)):
+                if total <= self.max_loaded_bytes:
+                    break
+                if key not in keys and key not in self.pinned:
+                    del self.loaded[key]
+                    self._last_used.pop(key, None)
+                    total -= nbytes[key]
+
+    def pin(self, keys):
+        """ Protects loaded catalogs from being deleted when the loaded
+        catalogs take more memory than self.max_loaded_bytes.
+
+        Parameters
+        ----------
+        keys : str or list of str
+          Keys to the loaded catalogs in the self.loaded dictionary, e.g.
+          'SubLink0'. Catalogs may be pinned before they are loaded.
+
+        Returns
+        -------
+        None :
+          Adds the keys to the self.pinned set. `clear_loaded` still deletes
+          pinned catalogs.
+
+        """
+
+        if isinstance(keys, str):
+            keys = [keys]
+        with self._lock:
+            self.pinned.update(keys)
         return
 
-    def clear_loaded(self, keep_catalogs=None):
+    def unpin(self, keys):
+        """ Lets pinned catalogs be deleted again when the loaded catalogs
+        take more memory than self.max_loaded_bytes.
+
+        Parameters
+        ----------
+        keys : str or list of str
+          Keys to the loaded catalogs in the self.loaded dictionary.
+
+        Returns
+        -------
+        None :
+          Removes the keys from the self.pinned set.
+
+        """
+
+        if isinstance(keys, str):
+            keys = [keys]
+        with self._lock:
+            self.pinned.difference_update(keys)
+        return
+
+    def clear_loaded(self, keep_catalogs=None, force_gc=False):
         """ Deletes part or all of the loaded catalogs to release memory.
 
         Parameters
         ----------
         keep_catalogs : list of str, optional
           List of keys to the loaded categories that are to be kept. The
-          rest will be deleted. Default is None, in which case all loaded
-          catalogs will be deleted.
+          rest will be deleted. Keys of catalogs that are still being
+          prefetched may be kept too, any other key raises KeyError.
+          Default is None, in which case all loaded catalogs will be
+          deleted.
+
+        force_gc : bool, optional
+          If True, also run the garbage collector afterwards. Default is
+          False: the arrays are freed as soon as the catalogs are deleted,
+          unless the caller still holds references to them.
 
         Returns
         -------
@@ -235,8 +509,24 @@ class SimulationBox:
             keep_catalogs = [keep_catalogs]
 
         if keep_catalogs:
-            self.loaded = {k: self.loaded[k] for k in keep_catalogs}
+            for k in keep_catalogs:
+                if k not in self.loaded and k not in self._prefetched:
+                    raise KeyError(k)
+            # A kept catalog may still be waiting on its prefetch, in
+            # which case only the pending read is kept
+            self.loaded = {k: self.loaded[k] for k in keep_catalogs
+                           if k in self.loaded}
+            self._prefetched = {k: self._prefetched[k] for k in keep_catalogs
+                                if k in self._prefetched}
         else:
             self.loaded = {}
-        gc.collect()
+            self._prefetched = {}
+        self._last_used = {k: t for k, t in self._last_used.items()
+                           if k in self.loaded}
+        if self._executor is not None:
+            # Reads still pending for kept catalogs finish in the background
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if force_gc:
+            gc.collect()
         return
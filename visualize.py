@@ -1,5 +1,4 @@
 import numpy as np
-from matplotlib import pyplot as pyplot
 
 def plot_subhalo_tree():
     pass